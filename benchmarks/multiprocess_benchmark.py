@@ -0,0 +1,130 @@
+"""
+Measures throughput of the extended backends when hammered by several worker
+processes at once, the way a prefork server uses them, then the latency of
+misses and sets once the cache has churned through, and filled, MAX_ENTRIES keys.
+
+    python ./benchmarks/multiprocess_benchmark.py [processes] [operations]
+
+Note that ExtendedLocMemCache numbers are per-process: its counters, locks and
+hashmaps are not shared between the workers so they are only a lower bound on
+cost, not a like for like comparison. The redis backend is skipped if no
+server is listening on 127.0.0.1:6379.
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+MAX_ENTRIES = 65536
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django
+from django.conf import settings
+
+settings.configure(CACHES={
+    "default": {
+        "BACKEND": "extended_django_redis.locmem_cache.ExtendedLocMemCache",
+    },
+    "locmem": {
+        "BACKEND": "extended_django_redis.locmem_cache.ExtendedLocMemCache",
+    },
+    "shared_memory": {
+        "BACKEND": "extended_django_redis.shared_memory_cache.ExtendedSharedMemoryCache",
+        "LOCATION": os.path.join(tempfile.gettempdir(), "extended-django-redis-benchmark.cache"),
+        "OPTIONS": {"MAX_ENTRIES": MAX_ENTRIES},
+    },
+    "redis": {
+        "BACKEND": "extended_django_redis.redis_cache.ExtendedRedisCache",
+        "LOCATION": "redis://127.0.0.1:6379?db=1",
+        "KEY_PREFIX": "benchmark",
+    },
+})
+django.setup()
+
+from django.core.cache import caches
+
+
+def work(alias, operations, start_event):
+    cache = caches[alias]
+    start_event.wait()
+    for i in range(operations):
+        key = "key-%d" % (i % 512)
+        cache.counter("counter")
+        cache.set(key, i)
+        cache.get(key)
+        cache.set_hashmap("hashmap-%d" % (i % 64), {"field": i})
+        cache.get_hashmap_value("hashmap-%d" % (i % 64), "field")
+
+
+def run(alias, processes, operations):
+    cache = caches[alias]
+    try:
+        cache.clear()
+    except Exception as e:
+        print("%-15s skipped (%s)" % (alias, e))
+        return
+
+    context = multiprocessing.get_context("fork")
+    start_event = context.Event()
+    workers = [context.Process(target=work, args=(alias, operations, start_event)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+
+    start = time.perf_counter()
+    start_event.set()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    # each iteration of work performs five cache calls
+    total = processes * operations * 5
+    print("%-15s %10.0f ops/s  counter=%s" % (alias, total / elapsed, cache.get("counter")))
+
+
+def timed(cache, operation, count=2000):
+    start = time.perf_counter()
+    for i in range(count):
+        operation(cache, i)
+    return (time.perf_counter() - start) / count * 1000000
+
+
+def miss(cache, i):
+    cache.get("missing-%d" % i)
+
+
+def set_new(cache, i):
+    cache.set("new-%d" % i, i)
+
+
+def churn(alias):
+    cache = caches[alias]
+    try:
+        cache.clear()
+    except Exception as e:
+        print("%-15s skipped (%s)" % (alias, e))
+        return
+
+    # one set and delete pass over every slot
+    for i in range(MAX_ENTRIES):
+        cache.set("churn-%d" % i, i)
+        cache.delete("churn-%d" % i)
+    after_churn = timed(cache, miss)
+
+    # more live keys than there are slots
+    for i in range(MAX_ENTRIES * 2):
+        cache.set("full-%d" % i, i)
+    print("%-15s miss after churn %7.1f us  miss when full %7.1f us  set when full %7.1f us" % (
+        alias, after_churn, timed(cache, miss), timed(cache, set_new)))
+
+
+if __name__ == "__main__":
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    operations = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    print("%d processes x %d iterations" % (processes, operations))
+    for alias in ("locmem", "shared_memory", "redis"):
+        run(alias, processes, operations)
+    print("%d entries churned" % MAX_ENTRIES)
+    for alias in ("locmem", "shared_memory", "redis"):
+        churn(alias)
@@ -0,0 +1,75 @@
+"""
+Measures how long ExtendedLocMemCache takes to dump and reload a snapshot and
+the longest time a dump holds the cache lock, which is how long a concurrent
+cache call can be stalled by a periodic snapshot.
+
+    python ./benchmarks/snapshot_benchmark.py [entries]
+
+A tenth of the entries are small hashmaps, the rest are short strings.
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django
+from django.conf import settings
+
+ENTRIES = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+settings.configure(CACHES={
+    "default": {
+        "BACKEND": "extended_django_redis.locmem_cache.ExtendedLocMemCache",
+        "OPTIONS": {"MAX_ENTRIES": ENTRIES + 1},
+    },
+})
+django.setup()
+
+from django.core.cache import cache
+
+
+class TimedLock:
+    """Wraps the cache lock to record the longest time it is held"""
+
+    def __init__(self, lock):
+        self._lock = lock
+        self.longest_hold = 0.0
+
+    def __enter__(self):
+        self._lock.acquire()
+        self._acquired_at = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.longest_hold = max(self.longest_hold, time.perf_counter() - self._acquired_at)
+        self._lock.release()
+
+
+if __name__ == "__main__":
+    for i in range(ENTRIES):
+        if i % 10 == 0:
+            cache.set_hashmap("hashmap-%d" % i, {"a": i, "b": "value-%d" % i})
+        else:
+            cache.set("key-%d" % i, "value-%d" % i, timeout=3600)
+
+    path = os.path.join(tempfile.mkdtemp(), "snapshot")
+
+    cache_lock = cache._lock
+    cache._lock = timed_lock = TimedLock(cache_lock)
+    start = time.perf_counter()
+    written = cache.dump(path)
+    dump_time = time.perf_counter() - start
+    cache._lock = cache_lock
+
+    cache.clear()
+
+    start = time.perf_counter()
+    loaded = cache.load(path)
+    load_time = time.perf_counter() - start
+
+    print("entries:  %d" % written)
+    print("size:     %.1f MB" % (os.path.getsize(path) / 1024 / 1024))
+    print("dump:     %.2f s (lock held for at most %.1f ms)" % (dump_time, timed_lock.longest_hold * 1000))
+    print("load:     %.2f s (%d entries)" % (load_time, loaded))
+    os.unlink(path)
@@ -1,5 +1,6 @@
 from .base_cache import ExtendedBaseCache
 from .locmem_cache import ExtendedLocMemCache
 from .redis_cache import ExtendedRedisCache
+from .shared_memory_cache import ExtendedSharedMemoryCache
 
-__all__ = ["ExtendedBaseCache", "ExtendedLocMemCache", "ExtendedRedisCache"]
+__all__ = ["ExtendedBaseCache", "ExtendedLocMemCache", "ExtendedRedisCache", "ExtendedSharedMemoryCache"]
@@ -1,5 +1,6 @@
 from django.core.cache.backends.base import BaseCache
 from abc import ABC, abstractmethod
+from .profiler import get_profiler, profile_operations
 
 
 class CacheAndClientSharedInterface(ABC):
@@ -31,6 +32,20 @@ class CacheAndClientSharedInterface(ABC):
     """
     pass
 
+  @abstractmethod
+  def ttls(self, keys, **kwargs):
+    """
+    Same as ttl for many keys at once, returns a dictionary of key to ttl.
+    """
+    pass
+
+  @abstractmethod
+  def ages(self, keys, original_ttl, **kwargs):
+    """
+    Same as age for many keys at once, returns a dictionary of key to age.
+    """
+    pass
+
   @abstractmethod
   def set_hashmap(self, key, dict, **kwargs):
     """
@@ -62,4 +77,25 @@ class CacheAndClientSharedInterface(ABC):
 
 
 class ExtendedBaseCache(BaseCache, CacheAndClientSharedInterface):
-  pass
+
+  _profiler = None
+
+  def _init_profiler(self, name, params):
+    """
+    If OPTIONS contains a PROFILER dictionary, wraps this instance's operations
+    so that a sample of calls is recorded in a KeyProfiler shared by every
+    instance with the same name.
+    """
+    options = params.get("OPTIONS", {}).get("PROFILER", None)
+    if options is not None:
+      self._profiler = get_profiler(repr((type(self).__name__, name)), options)
+      profile_operations(self, self._profiler)
+
+  def hot_keys(self, count=20):
+    """
+    Returns this process's estimate of the most used keys, the key prefixes
+    transferring the most bytes and the calls per operation.
+    """
+    if self._profiler is None:
+      raise ValueError("hot_keys requires a PROFILER option")
+    return self._profiler.report(count)
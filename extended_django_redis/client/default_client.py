@@ -1,11 +1,19 @@
+import socket
 import time
 from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django_redis.client import DefaultClient as DjangoRedisDefaultClient
 from django_redis.client.default import _main_exceptions
 from django_redis.exceptions import ConnectionInterrupted
 from .base_client import BaseClient
-from redis.lock import LockError
+from .read_router import get_read_router
+from ..locks import LockWatchdog, lock_statistics
+from redis.exceptions import ConnectionError, TimeoutError
+from redis.lock import Lock, LockError
 import functools
+import weakref
+
+# errors that mean the server itself is unhealthy rather than the command being wrong
+_server_exceptions = (ConnectionError, TimeoutError, socket.timeout)
 
 def extended_release(func):
 
@@ -22,17 +30,129 @@ def extended_release(func):
     return wrapper
 
 
+class InstrumentedLock(Lock):
+    """
+    Redis lock that records wait and hold times in lock_statistics and, with
+    watchdog=True, renews its lease in the background until it is released.
+    """
+
+    def __init__(self, redis, name, watchdog=False, **kwargs):
+        super().__init__(redis, name, **kwargs)
+        if watchdog and not self.timeout:
+            raise LockError("A watchdog requires a lock timeout")
+        self.watchdog = watchdog
+
+    def acquire(self, blocking=None, blocking_timeout=None, **kwargs):
+        if blocking is None:
+            blocking = self.blocking
+
+        started_at = time.monotonic()
+        acquired = super().acquire(blocking=False, **kwargs)
+        contended = not acquired
+        if contended and blocking:
+            acquired = super().acquire(blocking=True, blocking_timeout=blocking_timeout, **kwargs)
+
+        now = time.monotonic()
+        lock_statistics.record_acquire(self.name, now - started_at, acquired, contended)
+        if acquired:
+            self.local.acquired_at = now
+            if self.watchdog:
+                renew = functools.partial(self.do_renew, self.redis, self.name, self.local.token, self.timeout)
+                watchdog = self.local.watchdog = LockWatchdog(renew, self.timeout)
+                # a lock that is dropped without being released can never be released, stop renewing it
+                weakref.finalize(self, watchdog.stop)
+        return acquired
+
+    @staticmethod
+    def do_renew(redis, name, token, timeout):
+        "Resets the lease to timeout, returns False if the lock is no longer owned"
+        return bool(InstrumentedLock.lua_reacquire(keys=[name], args=[token, int(timeout * 1000)], client=redis))
+
+    def release(self):
+        watchdog = getattr(self.local, "watchdog", None)
+        if watchdog is not None:
+            watchdog.stop()
+            self.local.watchdog = None
+
+        acquired_at = getattr(self.local, "acquired_at", None)
+        if acquired_at is not None:
+            lock_statistics.record_release(self.name, time.monotonic() - acquired_at)
+            self.local.acquired_at = None
+
+        return super().release()
+
+
 class DefaultClient(DjangoRedisDefaultClient, BaseClient):
 
+    def __init__(self, server, params, backend):
+        super().__init__(server, params, backend)
+        self._read_router = get_read_router(self._server, self._options, self.connection_factory.connect)
+
+    def get_next_client_index(self, write=True, tried=()):
+        """
+        Writes use the default behaviour, reads go to the fastest healthy
+        replica, see ReadRouter.
+        """
+        if write:
+            return super().get_next_client_index(write=write, tried=tried)
+        return self._read_router.choose(tried)
+
+    def _read(self, command, client=None):
+        """
+        Runs command(client) against a read client, timing it for the router.
+        A server that cannot be reached is ejected and the read is retried on
+        the next best one.
+        """
+        if client is not None:
+            try:
+                return command(client)
+            except _main_exceptions as e:
+                raise ConnectionInterrupted(connection=client, parent=e)
+
+        tried = []
+        while True:
+            client, index = self.get_client(write=False, tried=tried, show_index=True)
+            started_at = time.monotonic()
+            try:
+                value = command(client)
+            except (ConnectionInterrupted,) + _main_exceptions as e:
+                # django redis' own reads arrive already wrapped in ConnectionInterrupted
+                cause = e.parent if isinstance(e, ConnectionInterrupted) else e
+                if isinstance(cause, _server_exceptions):
+                    self._read_router.eject(index)
+                    tried.append(index)
+                    if len(tried) < len(self._server):
+                        continue
+                if isinstance(e, ConnectionInterrupted):
+                    raise
+                raise ConnectionInterrupted(connection=client, parent=e)
+            self._read_router.record(index, time.monotonic() - started_at)
+            return value
+
+    def get(self, key, default=None, version=None, client=None):
+        return self._read(lambda client: super(DefaultClient, self).get(
+            key, default=default, version=version, client=client), client=client)
+
+    def get_many(self, keys, version=None, client=None):
+        return self._read(lambda client: super(DefaultClient, self).get_many(
+            keys, version=version, client=client), client=client)
+
+    def has_key(self, key, version=None, client=None):
+        return self._read(lambda client: super(DefaultClient, self).has_key(
+            key, version=version, client=client), client=client)
+
+    def ttl(self, key, version=None, client=None):
+        return self._read(lambda client: super(DefaultClient, self).ttl(
+            key, version=version, client=client), client=client)
 
     def lock(self, key, version=None, timeout=None, sleep=0.1,
-             blocking_timeout=None, client=None):
+             blocking_timeout=None, client=None, watchdog=False):
         if client is None:
             client = self.get_client(write=True)
 
         key = self.make_key(key, version=version)
-        lock = client.lock(key, timeout=timeout, sleep=sleep,
-                           blocking_timeout=blocking_timeout)
+        lock = InstrumentedLock(client, key, timeout=timeout, sleep=sleep,
+                                blocking_timeout=blocking_timeout, watchdog=watchdog)
 
         # wrap release so that we can decide whether or not to throw lock errors
         # this is to stop users from constantly having to write: try/finally inside of try/finally
@@ -69,6 +189,7 @@ class DefaultClient(DjangoRedisDefaultClient, BaseClient):
         except _main_exceptions as e:
             raise ConnectionInterrupted(connection=client, parent=e)
 
+        self._read_router.record_write()
         return value
 
     def age(self, key, original_ttl, version=None, client=None):
@@ -81,6 +202,39 @@ class DefaultClient(DjangoRedisDefaultClient, BaseClient):
             return None
         return original_ttl - ttl
 
+    def ttls(self, keys, version=None, client=None):
+        """
+        Returns a dictionary of key to ttl in seconds with millisecond precision,
+        fetched with PTTL in a single pipeline. Missing keys have a ttl of 0 and
+        keys that never expire a ttl of None.
+        """
+        keys = list(keys)
+
+        def pttls(client):
+            pipeline = client.pipeline(transaction=False)
+            for key in keys:
+                pipeline.pttl(self.make_key(key, version=version))
+            return pipeline.execute()
+
+        results = self._read(pttls, client=client)
+
+        ttls = {}
+        for key, pttl in zip(keys, results):
+            if pttl == -1:
+                ttls[key] = None
+            elif pttl < 0:
+                ttls[key] = 0
+            else:
+                ttls[key] = pttl / 1000
+        return ttls
+
+    def ages(self, keys, original_ttl, version=None, client=None):
+        """
+        Same as age for many keys in a single round trip.
+        """
+        ttls = self.ttls(keys, version=version, client=client)
+        return {key: None if ttl is None else original_ttl - ttl for key, ttl in ttls.items()}
+
     def delete_and_set_hashmap(self, key, dictionary, **kwargs):
         self._set_hashmap(key, dictionary, clear_existing=True, **kwargs)
 
@@ -104,41 +258,36 @@ class DefaultClient(DjangoRedisDefaultClient, BaseClient):
             raise TypeError("Hashmap keys must be strings")
 
         dictionary = {k if type(k) is str else NotStringException(): self.encode(v) for k, v in dictionary.items()}
-
-
-        # store update time, this has the added benefit of
-        # letting us save empty dictionaries in cache
-        # we pop this off before returning all keys
-        dictionary[last_set_key] = self.encode(int(time.time()))
+        list = [item for key in dictionary for item in (key, dictionary[key])]
 
         try:
-            if clear_existing:
-                list = [item for key in dictionary for item in (key, dictionary[key])]
-                lua = """
+            # store update time from the redis clock so that ages agree across hosts,
+            # this has the added benefit of letting us save empty dictionaries in cache
+            # we pop this off before returning all keys
+            lua = """
+            redis.replicate_commands()
+            if ARGV[1] == '1' then
                 redis.call('DEL', KEYS[1])
-                local result = redis.call('HMSET', KEYS[1], unpack(ARGV))
-                return result
-                """
-                value = client.eval(lua, 1, key, *list)
-            else:
-                value = client.hmset(key, dictionary)
+            end
+            for i = 3, #ARGV, 2 do
+                redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+            end
+            redis.call('HSET', KEYS[1], ARGV[2], redis.call('TIME')[1])
+            return 1
+            """
+            value = client.eval(lua, 1, key, int(clear_existing), last_set_key, *list)
         except _main_exceptions as e:
             raise ConnectionInterrupted(connection=client, parent=e)
-        return value
+
+        self._read_router.record_write()
+        return bool(value)
 
     def get_hashmap(self, key, version=None, client=None, decode=True, last_set_key="_last_set"):
         """
         Returns a python dictionary if it exists otherwise {}.
         """
-        if client is None:
-            client = self.get_client(write=False)
-
         key = self.make_key(key, version=version)
-
-        try:
-            value = client.hgetall(key)
-        except _main_exceptions as e:
-            raise ConnectionInterrupted(connection=client, parent=e)
+        value = self._read(lambda client: client.hgetall(key), client=client)
 
         dictionary = {k.decode('utf8'): self.decode(v) for k, v in value.items()}
         dictionary.pop(last_set_key, None)
@@ -148,18 +297,12 @@ class DefaultClient(DjangoRedisDefaultClient, BaseClient):
         """
         Returns they field if it exists, otherwise None
         """
-        if client is None:
-            client = self.get_client(write=False)
-
         key = self.make_key(key, version=version)
 
         if type(field) is not str:
             raise TypeError("Hashmap keys must be strings")
 
-        try:
-            value = client.hget(key, field)
-        except _main_exceptions as e:
-            raise ConnectionInterrupted(connection=client, parent=e)
+        value = self._read(lambda client: client.hget(key, field), client=client)
 
         if value is None:
             return None
@@ -0,0 +1,157 @@
+import functools
+import math
+import os
+import random
+import threading
+import time
+
+_routers = {}
+_routers_lock = threading.Lock()
+
+
+def get_read_router(servers, options, connect=None):
+    """
+    Returns the router for a set of servers, shared by every client in the
+    process so that latencies and ejections are not tracked per thread.
+    connect(url) returns a redis client, it is used to check the replicas.
+    """
+    eject_seconds = options.get("REPLICA_EJECT_SECONDS", 30)
+    latency_alpha = options.get("LATENCY_ALPHA", 0.2)
+    read_your_writes = options.get("READ_YOUR_WRITES", 0)
+    check_interval = options.get("REPLICA_CHECK_INTERVAL", 1)
+    max_lag = options.get("MAX_REPLICA_LAG", None)
+    key = (tuple(servers), eject_seconds, latency_alpha, read_your_writes, check_interval, max_lag)
+    with _routers_lock:
+        router = _routers.get(key, None)
+        if router is None:
+            probe = None
+            if connect is not None:
+                probe = functools.partial(_probe, connect, tuple(servers))
+            router = _routers[key] = ReadRouter(len(servers), eject_seconds=eject_seconds,
+                                                latency_alpha=latency_alpha, read_your_writes=read_your_writes,
+                                                probe=probe, check_interval=check_interval, max_lag=max_lag)
+        return router
+
+
+def replication_lag(client):
+    """
+    Returns the seconds since a replica last heard from its primary, infinity
+    if its link to the primary is down and 0 if the server is not a replica.
+    """
+    info = client.info("replication")
+    if info.get("role", None) != "slave":
+        return 0
+    if info.get("master_link_status", None) != "up":
+        return math.inf
+    return info.get("master_last_io_seconds_ago", 0)
+
+
+def _probe(connect, servers, index):
+    return replication_lag(connect(servers[index]))
+
+
+class ReadRouter:
+    """
+    Chooses which server a read goes to. Index 0 is the primary and the rest are
+    replicas. Reads go to the replica with the lowest exponentially weighted
+    moving average latency, replicas that fail are skipped for eject_seconds and
+    the primary is used when no replica is available. With read_your_writes a
+    thread's reads are pinned to the primary for that many seconds after it
+    writes.
+    Given a probe, probe(index) is called for every replica each check_interval
+    seconds from a background thread and returns the replica's replication lag.
+    Replicas whose link to the primary is down, that lag more than max_lag
+    seconds or whose probe fails are skipped for eject_seconds. Probes are timed
+    as well, so replicas that reads avoid are still re-measured without sending
+    any reads their way.
+    """
+
+    def __init__(self, servers, eject_seconds=30, latency_alpha=0.2, read_your_writes=0,
+                 probe=None, check_interval=1, max_lag=None):
+        self._servers = servers
+        self._eject_seconds = eject_seconds
+        self._latency_alpha = latency_alpha
+        self._read_your_writes = read_your_writes
+        self._probe = probe
+        self._check_interval = check_interval
+        self._max_lag = max_lag
+        self._latencies = [None] * servers
+        self._ejected_until = [0.0] * servers
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._checking_pid = None
+
+    def choose(self, tried=()):
+        if self._servers == 1:
+            return 0
+
+        if self._probe is not None and self._checking_pid != os.getpid():
+            self._start_checks()
+
+        now = time.monotonic()
+        if 0 not in tried and getattr(self._local, "pinned_until", 0) > now:
+            return 0
+
+        candidates = [i for i in range(1, self._servers) if i not in tried and self._ejected_until[i] <= now]
+        if not candidates:
+            if 0 not in tried:
+                return 0
+            candidates = [i for i in range(1, self._servers) if i not in tried] or [0]
+
+        unmeasured = [i for i in candidates if self._latencies[i] is None]
+        if unmeasured:
+            return random.choice(unmeasured)
+        return min(candidates, key=self._latencies.__getitem__)
+
+    def record(self, index, latency):
+        with self._lock:
+            average = self._latencies[index]
+            if average is None:
+                self._latencies[index] = latency
+            else:
+                self._latencies[index] = average + self._latency_alpha * (latency - average)
+
+    def eject(self, index):
+        with self._lock:
+            self._ejected_until[index] = time.monotonic() + self._eject_seconds
+            # measure it afresh once it is back
+            self._latencies[index] = None
+
+    def check(self):
+        """
+        Probes every replica once, recording how long the probe took and
+        ejecting replicas that fail or lag too far behind.
+        """
+        for index in range(1, self._servers):
+            started_at = time.monotonic()
+            try:
+                lag = self._probe(index)
+            except Exception:
+                self.eject(index)
+                continue
+            self.record(index, time.monotonic() - started_at)
+            if lag == math.inf or (self._max_lag is not None and lag > self._max_lag):
+                self.eject(index)
+
+    def _start_checks(self):
+        # called again in forked children, whose checking thread did not survive the fork
+        with self._lock:
+            if self._checking_pid == os.getpid():
+                return
+            self._checking_pid = os.getpid()
+
+        def check_forever():
+            while True:
+                time.sleep(self._check_interval)
+                self.check()
+
+        threading.Thread(target=check_forever, name="read-router-checks", daemon=True).start()
+
+    def record_write(self):
+        if self._read_your_writes:
+            self._local.pinned_until = time.monotonic() + self._read_your_writes
+
+    def latencies(self):
+        """Returns the moving average latency of every server, None if unmeasured"""
+        with self._lock:
+            return list(self._latencies)
@@ -0,0 +1,90 @@
+import threading
+
+
+class LockWatchdog:
+    """
+    Renews a lock's lease from a daemon thread every third of its timeout until
+    it is stopped, the renewal reports that the lock is no longer owned or the
+    thread that acquired the lock exits. A holder that crashes or forgets to
+    release therefore only blocks others for one lease. renew must not refer
+    to the lock object, so that a lock that is dropped can still be collected.
+    """
+
+    def __init__(self, renew, timeout):
+        self._renew = renew
+        self._owner = threading.current_thread()
+        self._interval = timeout / 3
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="lock-watchdog", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            if not self._owner.is_alive():
+                return
+            try:
+                if not self._renew():
+                    return
+            except Exception:
+                # a failed renewal may be transient, the lease survives until the next attempt
+                continue
+
+    def stop(self):
+        self._stopped.set()
+
+
+class LockStatistics:
+    """
+    Thread-safe, per-process counters of how long locks are waited for and held,
+    keyed by lock name.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _get(self, name):
+        stats = self._stats.get(name, None)
+        if stats is None:
+            stats = self._stats[name] = {
+                "acquired": 0,
+                "failed": 0,
+                "contended": 0,
+                "wait_total": 0.0,
+                "wait_max": 0.0,
+                "hold_total": 0.0,
+                "hold_max": 0.0,
+            }
+        return stats
+
+    def record_acquire(self, name, wait, acquired, contended):
+        """Records an acquire attempt, contended when the first try found the lock taken"""
+        with self._lock:
+            stats = self._get(name)
+            stats["acquired" if acquired else "failed"] += 1
+            if contended:
+                stats["contended"] += 1
+            stats["wait_total"] += wait
+            stats["wait_max"] = max(stats["wait_max"], wait)
+
+    def record_release(self, name, held):
+        with self._lock:
+            stats = self._get(name)
+            stats["hold_total"] += held
+            stats["hold_max"] = max(stats["hold_max"], held)
+
+    def stats(self):
+        """Returns a copy of the statistics for every lock seen by this process"""
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def hot_locks(self, count=10):
+        """Returns the names and statistics of the locks with the most total wait time"""
+        return sorted(self.stats().items(), key=lambda item: item[1]["wait_total"], reverse=True)[:count]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+lock_statistics = LockStatistics()
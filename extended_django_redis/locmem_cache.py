@@ -1,11 +1,56 @@
 from .base_cache import ExtendedBaseCache
+from .locks import LockWatchdog, lock_statistics
 from django.core.cache.backends.locmem import LocMemCache
+import atexit
+import functools
+import logging
+import mmap
+import os
 import pickle
+import struct
+import tempfile
+import threading
 import time
 import uuid
+import weakref
 
 DEFAULT_TIMEOUT = 300
 
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b"EDRSNAP1"
+# record header: kind, key length, expiry, payload length
+_RECORD = struct.Struct("<BHdI")
+# hashmap field header: field length, value length
+_FIELD = struct.Struct("<HI")
+_BYTES = 0
+_HASHMAP = 1
+_NO_EXPIRY = -1.0
+# entries copied per hold of the cache lock while dumping, so other calls are only delayed briefly
+DUMP_BATCH_SIZE = 10000
+
+# starts the snapshot thread of every named cache, shared by every thread's instance
+_snapshotters = {}
+_snapshotters_lock = threading.Lock()
+
+
+def _restart_snapshots():
+    # threads do not survive a fork, so every child, such as a worker forked from a
+    # preloading server, starts its own. The lock may have been held by another thread.
+    global _snapshotters_lock
+    _snapshotters_lock = threading.Lock()
+    for start in _snapshotters.values():
+        if start is not None:
+            start()
+
+
+os.register_at_fork(after_in_child=_restart_snapshots)
+
+def _pack_field(field, value):
+    field = field.encode()
+    return _FIELD.pack(len(field), len(value)) + field + value
+
+
 class LockError(Exception):
     pass
 
@@ -15,7 +60,9 @@ class InMemoryLock:
     Redis lock code adapted from redis.lock.Lock
     """
 
-    def __init__(self, cache, key, timeout=None, sleep=0.1, blocking_timeout=None, blocking=True):
+    def __init__(self, cache, key, timeout=None, sleep=0.1, blocking_timeout=None, blocking=True, watchdog=False):
+        if watchdog and not timeout:
+            raise LockError("A watchdog requires a lock timeout")
         self.cache = cache
         self.name = key
         self.key = key
@@ -24,6 +71,9 @@ class InMemoryLock:
         self.blocking_timeout = blocking_timeout
         self.blocking = blocking
         self.acquired_token = None
+        self.watchdog = watchdog
+        self._watchdog = None
+        self._acquired_at = None
 
     def __enter__(self):
         # force blocking, as otherwise the user would have to check whether
@@ -41,6 +91,8 @@ class InMemoryLock:
         was acquired, return True, otherwise return False.
         ``blocking_timeout`` specifies the maximum number of seconds to
         wait trying to acquire the lock.
+        If the lock was created with ``watchdog=True`` its lease is renewed
+        in the background until it is released.
         """
         sleep = self.sleep
         token = uuid.uuid1().hex
@@ -51,20 +103,34 @@ class InMemoryLock:
         if blocking is None:
             blocking = self.blocking
 
+        started_at = time.monotonic()
         stop_trying_at = None
         if blocking_timeout is not None:
             stop_trying_at = time.time() + blocking_timeout
 
+        contended = False
         while True:
             if self.do_acquire(token):
                 self.acquired_token = token
+                self._on_acquire(started_at, True, contended)
                 return True
-            if not blocking:
-                return False
-            if stop_trying_at is not None and time.time() > stop_trying_at:
+            contended = True
+            if not blocking or (stop_trying_at is not None and time.time() > stop_trying_at):
+                self._on_acquire(started_at, False, contended)
                 return False
             time.sleep(sleep)
 
+    def _on_acquire(self, started_at, acquired, contended):
+        now = time.monotonic()
+        lock_statistics.record_acquire(self.name, now - started_at, acquired, contended)
+        if acquired:
+            self._acquired_at = now
+            if self.watchdog:
+                renew = functools.partial(self.do_renew, self.cache, self.key, self.acquired_token, self.timeout)
+                self._watchdog = LockWatchdog(renew, self.timeout)
+                # a lock that is dropped without being released can never be released, stop renewing it
+                weakref.finalize(self, self._watchdog.stop)
+
     def do_acquire(self, token):
         with self.cache._lock:
             if self.cache._has_key(self.key):
@@ -72,10 +138,27 @@ class InMemoryLock:
             self.cache._set(self.key, token, self.timeout)
             return True
 
+    @staticmethod
+    def do_renew(cache, key, token, timeout):
+        "Resets the lease to timeout, returns False if the lock is no longer owned"
+        with cache._lock:
+            if not cache._has_key(key) or cache._cache[key] != token:
+                return False
+            cache._expire_info[key] = cache.get_backend_timeout(timeout)
+            return True
+
     def release(self, ignore_lock_errors=False):
         "Releases the already acquired lock"
         expected_token = self.acquired_token
 
+        if self._watchdog is not None:
+            self._watchdog.stop()
+            self._watchdog = None
+
+        if self._acquired_at is not None:
+            lock_statistics.record_release(self.name, time.monotonic() - self._acquired_at)
+            self._acquired_at = None
+
         if ignore_lock_errors:
             try:
                 self.do_release(expected_token)
@@ -100,30 +183,194 @@ class InMemoryLock:
 
 class ExtendedLocMemCache(LocMemCache, ExtendedBaseCache):
 
+    def __init__(self, name, params):
+        super().__init__(name, params)
+        self._init_profiler(name, params)
+        options = params.get("OPTIONS", {})
+        snapshot_path = options.get("SNAPSHOT_PATH", None)
+        if snapshot_path is not None:
+            self._start_snapshots(name, snapshot_path, options.get("SNAPSHOT_INTERVAL", None))
+
+    def _start_snapshots(self, name, path, interval):
+        """
+        Restores the cache from path the first time it is created in this process
+        and then writes it back every interval seconds and when the process exits.
+        Forked children keep writing every interval seconds.
+        """
+        with _snapshotters_lock:
+            if name in _snapshotters:
+                return
+            _snapshotters[name] = None
+
+        if os.path.exists(path):
+            self.load(path)
+
+        atexit.register(self._dump_quietly, path)
+
+        if interval:
+            def snapshot_forever():
+                while True:
+                    time.sleep(interval)
+                    self._dump_quietly(path)
+
+            def start():
+                threading.Thread(target=snapshot_forever, name="locmem-snapshot-%s" % name, daemon=True).start()
+
+            _snapshotters[name] = start
+            start()
+
+    def _dump_quietly(self, path):
+        # a failed snapshot must not stop later ones or the interpreter's exit
+        try:
+            self.dump(path)
+        except Exception:
+            logger.exception("Could not write cache snapshot to %s", path)
+
+    def dump(self, path):
+        """
+        Writes every live entry, hashmaps included, to path in most to least
+        recently used order and returns the number of entries written. Records
+        are streamed to a temporary file that then replaces path so readers never
+        see a partial snapshot. Locks are not written.
+        The order is taken when the dump starts and entries are then copied
+        DUMP_BATCH_SIZE at a time, releasing the cache lock in between, so keys
+        changed during the dump are written with whichever value they had when
+        their batch was copied.
+        """
+        with self._lock:
+            keys = list(self._cache)
+
+        now = time.time()
+        count = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".snapshot-")
+        try:
+            with os.fdopen(fd, "wb", buffering=1024 * 1024) as f:
+                f.write(SNAPSHOT_MAGIC)
+                for start in range(0, len(keys), DUMP_BATCH_SIZE):
+                    count += self._dump_batch(f, keys[start:start + DUMP_BATCH_SIZE], now)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return count
+
+    def _dump_batch(self, f, keys, now):
+        with self._lock:
+            # hashmaps are updated in place, so copy them while the lock is held
+            values = [value if type(value) is not dict else dict(value) for value in map(self._cache.get, keys)]
+            expiries = list(map(self._expire_info.get, keys))
+
+        count = 0
+        for key, value, expiry in zip(keys, values, expiries):
+            if type(value) not in (bytes, dict) or (expiry is not None and expiry <= now):
+                continue
+            key = key.encode()
+            if type(value) is dict:
+                kind = _HASHMAP
+                payload = b"".join(_pack_field(field, field_value) for field, field_value in value.items())
+            else:
+                kind = _BYTES
+                payload = value
+            f.write(_RECORD.pack(kind, len(key), _NO_EXPIRY if expiry is None else expiry, len(payload)))
+            f.write(key)
+            f.write(payload)
+            count += 1
+        return count
+
+    def load(self, path):
+        """
+        Reads a snapshot written by dump into the cache and returns the number of
+        entries restored. Expired entries and keys that are already cached are
+        skipped, and loading stops once MAX_ENTRIES is reached. Restored entries
+        keep their relative recency but rank below anything already cached.
+        """
+        now = time.time()
+        count = 0
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as snapshot:
+            if snapshot[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                raise ValueError("%s is not a cache snapshot" % path)
+
+            offset = len(SNAPSHOT_MAGIC)
+            size = len(snapshot)
+            with self._lock:
+                while offset < size and len(self._cache) < self._max_entries:
+                    kind, key_length, expiry, payload_length = _RECORD.unpack_from(snapshot, offset)
+                    offset += _RECORD.size
+                    key_end = offset + key_length
+                    end = key_end + payload_length
+                    if expiry == _NO_EXPIRY:
+                        expiry = None
+                    elif expiry <= now:
+                        offset = end
+                        continue
+
+                    key = snapshot[offset:key_end].decode()
+                    if key in self._cache:
+                        offset = end
+                        continue
+
+                    if kind == _HASHMAP:
+                        value = {}
+                        field_offset = key_end
+                        while field_offset < end:
+                            field_length, value_length = _FIELD.unpack_from(snapshot, field_offset)
+                            field_offset += _FIELD.size
+                            field = snapshot[field_offset:field_offset + field_length].decode()
+                            field_offset += field_length
+                            value[field] = snapshot[field_offset:field_offset + value_length]
+                            field_offset += value_length
+                    else:
+                        value = snapshot[key_end:end]
+
+                    # appending keeps the snapshot's recency order behind existing entries
+                    self._cache[key] = value
+                    self._expire_info[key] = expiry
+                    offset = end
+                    count += 1
+        return count
+
     def _has_key(self, key):
         if self._has_expired(key):
             self._delete(key)
             return False
         return True
 
-    def lock(self, key, version=None, timeout=DEFAULT_TIMEOUT, sleep=0.1, blocking_timeout=None, **kwargs):
+    def lock(self, key, version=None, timeout=DEFAULT_TIMEOUT, sleep=0.1, blocking_timeout=None, watchdog=False, **kwargs):
         key = self.make_key(key, version=version)
         self.validate_key(key)
-        return InMemoryLock(self, key, timeout=timeout, sleep=sleep, blocking_timeout=blocking_timeout)
+        return InMemoryLock(self, key, timeout=timeout, sleep=sleep, blocking_timeout=blocking_timeout, watchdog=watchdog)
 
     def ttl(self, key, version=None, **kwargs):
         """Obtains the time before expiry for a given key"""
         key = self.make_key(key, version=version)
         self.validate_key(key)
         with self._lock:
-            if self._cache.get(key, None) is None:
-                return 0
-            if self._has_expired(key):
-                return 0
-            exp = self._expire_info.get(key, None)
-            if (exp is None):
-                return None
-            return exp - time.time()
+            return self._ttl(key)
+
+    def _ttl(self, key):
+        if self._cache.get(key, None) is None:
+            return 0
+        if self._has_expired(key):
+            return 0
+        exp = self._expire_info.get(key, None)
+        if (exp is None):
+            return None
+        return exp - time.time()
+
+    def ttls(self, keys, version=None, **kwargs):
+        """Obtains the time before expiry for many keys while holding the lock once"""
+        return self._ttls(keys, version=version)
+
+    def _ttls(self, keys, version=None):
+        made_keys = []
+        for key in keys:
+            made_key = self.make_key(key, version=version)
+            self.validate_key(made_key)
+            made_keys.append((key, made_key))
+
+        with self._lock:
+            return {key: self._ttl(made_key) for key, made_key in made_keys}
 
     def counter(self, key, delta=1, timeout=DEFAULT_TIMEOUT, version=None, **kwargs):
         key = self.make_key(key, version=version)
@@ -154,6 +401,10 @@ class ExtendedLocMemCache(LocMemCache, ExtendedBaseCache):
             return original_ttl
         return original_ttl - exp
 
+    def ages(self, keys, original_ttl, version=None, **kwargs):
+        ttls = self._ttls(keys, version=version)
+        return {key: None if ttl is None else original_ttl - ttl for key, ttl in ttls.items()}
+
     def delete_and_set_hashmap(self, key, dictionary, **kwargs):
         self._set_hashmap(key, dictionary, clear_existing=True, **kwargs)
 
@@ -0,0 +1,31 @@
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from ...profiler import merge_reports
+import json
+
+
+class Command(BaseCommand):
+    help = (
+        "Prints the hottest keys and heaviest key prefixes recorded by a cache's PROFILER, "
+        "merging the reports every process writes to the profiler's REPORT_DIR."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--cache", default="default", help="The cache alias to report on")
+        parser.add_argument("--count", type=int, default=20, help="The number of keys and prefixes to show")
+
+    def handle(self, *args, **options):
+        cache = caches[options["cache"]]
+        profiler = getattr(cache, "_profiler", None)
+        if profiler is None:
+            raise CommandError("The '%s' cache has no PROFILER option" % options["cache"])
+
+        if profiler.report_dir is None:
+            # this process serves no traffic, only the reports written by the ones that do are useful
+            raise CommandError(
+                "The '%s' cache's PROFILER has no REPORT_DIR for serving processes to write their reports to, "
+                "use cache.hot_keys() in those processes instead" % options["cache"])
+
+        report = merge_reports(profiler.read_reports(), options["count"])
+
+        self.stdout.write(json.dumps(report, indent=2))
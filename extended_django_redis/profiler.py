@@ -0,0 +1,264 @@
+from django.core.cache.backends.base import BaseCache
+import functools
+import glob
+import json
+import os
+import pickle
+import random
+import threading
+import time
+
+DEFAULT_SAMPLE_RATE = 0.01
+DEFAULT_CAPACITY = 1000
+DEFAULT_REPORT_INTERVAL = 60
+# reports not rewritten for this many intervals belong to processes that have exited
+STALE_REPORT_INTERVALS = 3
+
+# the size of the value written or read is recorded for these
+_WRITE_OPERATIONS = {"set", "add", "set_hashmap", "delete_and_set_hashmap"}
+_READ_OPERATIONS = {"get", "get_hashmap", "get_hashmap_value", "counter", "incr", "decr"}
+# these take a list of keys, or a dict for set_many, instead of a key
+_MANY_OPERATIONS = {"get_many", "set_many", "delete_many", "ttls", "ages"}
+_DERIVED_OPERATIONS = {"get_many", "set_many", "delete_many", "decr"}
+_OPERATIONS = _WRITE_OPERATIONS | _READ_OPERATIONS | _MANY_OPERATIONS | {"delete", "touch", "lock", "ttl", "age"}
+
+_profilers = {}
+_profilers_lock = threading.Lock()
+
+
+def get_profiler(name, options):
+    """
+    Returns the profiler for a cache location, shared by every thread's
+    instance of the cache.
+    """
+    with _profilers_lock:
+        profiler = _profilers.get(name, None)
+        if profiler is None:
+            profiler = _profilers[name] = KeyProfiler(
+                sample_rate=options.get("SAMPLE_RATE", DEFAULT_SAMPLE_RATE),
+                capacity=options.get("CAPACITY", DEFAULT_CAPACITY),
+                prefix_delimiter=options.get("PREFIX_DELIMITER", ":"),
+                report_dir=options.get("REPORT_DIR", None),
+                report_interval=options.get("REPORT_INTERVAL", DEFAULT_REPORT_INTERVAL),
+            )
+        return profiler
+
+
+def _size(value):
+    if value is None:
+        return 0
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    try:
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return 0
+
+
+class SpaceSaving:
+    """
+    Space-saving top-k counter (Metwally et al.). Tracks at most capacity items,
+    an untracked item replaces the smallest one and inherits its count as the
+    error bound, so every item heavier than total / capacity is guaranteed to
+    be tracked.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._counts = {}
+        self._errors = {}
+
+    def offer(self, item, weight=1):
+        if item in self._counts:
+            self._counts[item] += weight
+            return
+        if len(self._counts) < self.capacity:
+            self._counts[item] = weight
+            self._errors[item] = 0
+            return
+        smallest = min(self._counts, key=self._counts.__getitem__)
+        count = self._counts.pop(smallest)
+        del self._errors[smallest]
+        self._counts[item] = count + weight
+        self._errors[item] = count
+
+    def top(self, count):
+        """Returns up to count (item, count, error) tuples, largest first"""
+        items = sorted(self._counts.items(), key=lambda item: item[1], reverse=True)[:count]
+        return [(item, weight, self._errors[item]) for item, weight in items]
+
+
+class KeyProfiler:
+    """
+    Samples cache calls to estimate the hottest keys and the bytes moved per
+    key prefix. Unsampled calls cost one random number, sampled ones update
+    bounded space-saving counters under a lock. Reports scale the sampled
+    counts by the sample rate.
+    """
+
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE, capacity=DEFAULT_CAPACITY, prefix_delimiter=":",
+                 report_dir=None, report_interval=DEFAULT_REPORT_INTERVAL):
+        self.sample_rate = sample_rate
+        self.capacity = capacity
+        self.prefix_delimiter = prefix_delimiter
+        self.report_dir = report_dir
+        self.report_interval = report_interval
+        self._lock = threading.Lock()
+        self._reporting_pid = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._samples = 0
+            self._keys = SpaceSaving(self.capacity)
+            self._prefixes = SpaceSaving(self.capacity)
+            self._operations = {}
+
+    def sampled(self):
+        return random.random() < self.sample_rate
+
+    def record(self, operation, key, value=None):
+        key = str(key)
+        prefix = key.split(self.prefix_delimiter, 1)[0]
+        size = _size(value)
+        with self._lock:
+            self._samples += 1
+            self._keys.offer(key)
+            # misses and deletes move no bytes and would only push real prefixes out
+            if size:
+                self._prefixes.offer(prefix, size)
+            self._operations[operation] = self._operations.get(operation, 0) + 1
+        if self.report_dir is not None and self._reporting_pid != os.getpid():
+            self._start_reporting()
+
+    def report(self, count=20):
+        """
+        Returns the estimated call counts of the hottest keys, the estimated
+        bytes transferred for the heaviest key prefixes and the estimated calls
+        per operation.
+        """
+        scale = 1 / self.sample_rate
+        with self._lock:
+            return {
+                "sample_rate": self.sample_rate,
+                "samples": self._samples,
+                "keys": [
+                    {"key": key, "count": round(weight * scale), "error": round(error * scale)}
+                    for key, weight, error in self._keys.top(count)
+                ],
+                "prefixes": [
+                    {"prefix": prefix, "bytes": round(weight * scale), "error": round(error * scale)}
+                    for prefix, weight, error in self._prefixes.top(count)
+                ],
+                "operations": {operation: round(calls * scale) for operation, calls in self._operations.items()},
+            }
+
+    def _start_reporting(self):
+        # called again in forked children, whose reporting thread did not survive the fork
+        with self._lock:
+            if self._reporting_pid == os.getpid():
+                return
+            self._reporting_pid = os.getpid()
+
+        def report_forever():
+            while True:
+                time.sleep(self.report_interval)
+                self.write_report()
+
+        threading.Thread(target=report_forever, name="key-profiler-report", daemon=True).start()
+
+    def write_report(self):
+        """Writes this process's full report to REPORT_DIR for the hot_keys command"""
+        os.makedirs(self.report_dir, exist_ok=True)
+        path = os.path.join(self.report_dir, "hot-keys-%d.json" % os.getpid())
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.report(self.capacity), f)
+        os.replace(temp_path, path)
+
+    def read_reports(self):
+        """
+        Returns the latest report written by every live process, deleting the
+        reports of processes that stopped writing them.
+        """
+        stale_before = time.time() - self.report_interval * STALE_REPORT_INTERVALS
+        reports = []
+        for path in glob.glob(os.path.join(self.report_dir, "hot-keys-*.json")):
+            try:
+                if os.path.getmtime(path) < stale_before:
+                    os.remove(path)
+                    continue
+                with open(path) as f:
+                    reports.append(json.load(f))
+            except FileNotFoundError:
+                # removed by another reader or replaced while we looked
+                continue
+        return reports
+
+
+def merge_reports(reports, count=20):
+    """Combines reports from several processes into one"""
+    keys = {}
+    prefixes = {}
+    operations = {}
+    for report in reports:
+        for entry in report["keys"]:
+            keys[entry["key"]] = keys.get(entry["key"], 0) + entry["count"]
+        for entry in report["prefixes"]:
+            prefixes[entry["prefix"]] = prefixes.get(entry["prefix"], 0) + entry["bytes"]
+        for operation, calls in report["operations"].items():
+            operations[operation] = operations.get(operation, 0) + calls
+    return {
+        "keys": [{"key": key, "count": calls} for key, calls in sorted(keys.items(), key=lambda item: item[1], reverse=True)[:count]],
+        "prefixes": [{"prefix": prefix, "bytes": size} for prefix, size in sorted(prefixes.items(), key=lambda item: item[1], reverse=True)[:count]],
+        "operations": operations,
+    }
+
+
+def _sample_keys(profiler, operation, keys, values=None):
+    for key in keys:
+        if profiler.sampled():
+            profiler.record(operation, key, None if values is None else values.get(key, None))
+
+
+def _profiled(profiler, operation, method):
+    if operation in _MANY_OPERATIONS:
+        @functools.wraps(method)
+        def wrapper(keys, *args, **kwargs):
+            if operation == "set_many":
+                result = method(keys, *args, **kwargs)
+                _sample_keys(profiler, operation, keys, keys)
+                return result
+            keys = list(keys)
+            result = method(keys, *args, **kwargs)
+            _sample_keys(profiler, operation, keys, result if operation == "get_many" else None)
+            return result
+    else:
+        @functools.wraps(method)
+        def wrapper(key, *args, **kwargs):
+            result = method(key, *args, **kwargs)
+            if profiler.sampled():
+                if operation in _WRITE_OPERATIONS:
+                    value = args[0] if args else kwargs.get("value", kwargs.get("dictionary", kwargs.get("hashmap", None)))
+                elif operation in _READ_OPERATIONS:
+                    value = result
+                else:
+                    value = None
+                profiler.record(operation, key, value)
+            return result
+    return wrapper
+
+
+def profile_operations(cache, profiler):
+    """
+    Replaces the cache instance's operations with wrappers that record sampled
+    calls. Operations that BaseCache implements on top of others, such as
+    get_many calling get, are left alone so that calls are not counted twice.
+    """
+    for operation in _OPERATIONS:
+        method = getattr(cache, operation, None)
+        if method is None:
+            continue
+        if operation in _DERIVED_OPERATIONS and getattr(type(cache), operation) is getattr(BaseCache, operation):
+            continue
+        setattr(cache, operation, _profiled(profiler, operation, method))
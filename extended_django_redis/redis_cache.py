@@ -8,6 +8,7 @@ class ExtendedRedisCache(RedisCache, ExtendedBaseCache):
     options = params.setdefault("OPTIONS", {})
     options.setdefault("CLIENT_CLASS", "extended_django_redis.client.DefaultClient")
     super().__init__(server, params)
+    self._init_profiler(server, params)
 
   @omit_exception
   def counter(self, key, **kwargs):
@@ -17,6 +18,14 @@ class ExtendedRedisCache(RedisCache, ExtendedBaseCache):
   def age(self, key, original_ttl, **kwargs):
     return self.client.age(key, original_ttl, **kwargs)
 
+  @omit_exception
+  def ttls(self, keys, **kwargs):
+    return self.client.ttls(keys, **kwargs)
+
+  @omit_exception
+  def ages(self, keys, original_ttl, **kwargs):
+    return self.client.ages(keys, original_ttl, **kwargs)
+
   @omit_exception
   def set_hashmap(self, key, hashmap, **kwargs):
     return self.client.set_hashmap(key, hashmap, **kwargs)
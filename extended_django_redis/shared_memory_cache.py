@@ -0,0 +1,438 @@
+from .base_cache import ExtendedBaseCache
+from .locmem_cache import InMemoryLock, LockError
+from contextlib import contextmanager
+from django.core.cache.backends.base import DEFAULT_TIMEOUT as DJANGO_DEFAULT_TIMEOUT
+from django.core.exceptions import ImproperlyConfigured
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import pickle
+import stat
+import struct
+import threading
+import time
+
+DEFAULT_TIMEOUT = 300
+DEFAULT_SLOT_SIZE = 1024
+DEFAULT_MAX_PROBE = 32
+
+MAGIC = b"EDRSHM02"
+
+# file header: magic, number of slots, slot size, max probe
+_HEADER = struct.Struct("<8sIII")
+# slot header: state, key hash, expiry, key length, value length
+_SLOT = struct.Struct("<BQdHI")
+_EXPIRY = struct.Struct("<d")
+_EXPIRY_OFFSET = struct.calcsize("<BQ")
+
+EMPTY = 0
+USED = 1
+DELETED = 2
+# a held lock, never evicted to make room for other keys
+LOCKED = 3
+_LIVE = (USED, LOCKED)
+
+
+def _hash(key_bytes):
+    return int.from_bytes(hashlib.blake2b(key_bytes, digest_size=8).digest(), "little")
+
+
+class SharedMemoryLock(InMemoryLock):
+    """
+    InMemoryLock whose token lives in the shared table so that it excludes
+    other processes as well as other threads.
+    """
+
+    def do_acquire(self, token):
+        return self.cache._add_raw(self.key, token.encode(), self.timeout, locked=True)
+
+    def do_release(self, expected_token):
+        if expected_token is None:
+            raise LockError("Cannot release an unlocked lock")
+
+        if not self.cache._delete_raw(self.key, expected=expected_token.encode()):
+            raise LockError("Cannot release a lock that's no longer owned")
+
+    @staticmethod
+    def do_renew(cache, key, token, timeout):
+        return cache._touch_raw(key, timeout, expected=token.encode())
+
+
+class ExtendedSharedMemoryCache(ExtendedBaseCache):
+    """
+    A cache shared by every process on the host. Entries are stored in a
+    memory-mapped file laid out as a fixed-slot, linearly probed hash table.
+    The number of slots is MAX_ENTRIES and each slot holds at most
+    OPTIONS["SLOT_SIZE"] bytes of key, value and header. A key only ever lives
+    within OPTIONS["MAX_PROBE"] slots of its home slot, so no operation reads
+    more slots than that, and when they are all taken the entry closest to
+    expiry is evicted. Held locks are never evicted. Every operation takes
+    an exclusive flock on the file so counters, locks and hashmaps are atomic
+    across processes.
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        if not location:
+            # a shared default would mix unrelated apps' entries in one table
+            raise ImproperlyConfigured("ExtendedSharedMemoryCache requires a LOCATION")
+        self._path = location
+        self._num_slots = self._max_entries
+        self._slot_size = int(options.get("SLOT_SIZE", DEFAULT_SLOT_SIZE))
+        if self._slot_size <= _SLOT.size:
+            raise ImproperlyConfigured("SLOT_SIZE must be larger than %d bytes" % _SLOT.size)
+        self._max_probe = min(int(options.get("MAX_PROBE", DEFAULT_MAX_PROBE)), self._num_slots)
+        self._size = _HEADER.size + self._num_slots * self._slot_size
+        self._pid = None
+        self._fd = None
+        self._map = None
+        self._thread_lock = threading.Lock()
+        self._init_profiler(location, params)
+
+    def _attach(self):
+        # file locks and mappings are not safe to share with a forked child,
+        # so every process opens the table for itself and drops the inherited ones
+        if self._map is not None:
+            self._map.close()
+            os.close(self._fd)
+            self._map = None
+            self._fd = None
+
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            # values are unpickled, so anyone who can write the file can run code in this process
+            file_stat = os.fstat(fd)
+            if file_stat.st_uid != os.geteuid() or file_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                raise ImproperlyConfigured(
+                    "%s must be owned by this user and not writable by its group or others" % self._path)
+
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                # every process must agree on MAX_PROBE too, or one with a shorter probe
+                # would miss keys placed further along and store a second copy
+                expected_header = _HEADER.pack(MAGIC, self._num_slots, self._slot_size, self._max_probe)
+                if file_stat.st_size == 0:
+                    os.ftruncate(fd, self._size)
+                    os.pwrite(fd, expected_header, 0)
+                if os.pread(fd, _HEADER.size, 0) != expected_header:
+                    raise ImproperlyConfigured(
+                        "%s was created with a different MAX_ENTRIES, SLOT_SIZE or MAX_PROBE" % self._path)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        except Exception:
+            os.close(fd)
+            raise
+
+        self._fd = fd
+        self._map = mmap.mmap(fd, self._size)
+        self._thread_lock = threading.Lock()
+        self._pid = os.getpid()
+
+    @contextmanager
+    def _locked(self):
+        if self._pid != os.getpid():
+            self._attach()
+        # flock only excludes other open files, threads sharing this one need their own lock
+        with self._thread_lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield self._map
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _expiry(self, timeout):
+        expiry = self.get_backend_timeout(timeout)
+        if expiry is None:
+            return math.inf
+        return expiry
+
+    def _offset(self, index):
+        return _HEADER.size + index * self._slot_size
+
+    def _find(self, table, key_bytes, key_hash):
+        """
+        Returns the slot index holding the key, or None along with the first
+        slot the key could be written to, None if all MAX_PROBE slots are taken.
+        Expired entries met on the way are reclaimed.
+        """
+        now = time.time()
+        free = None
+        home = key_hash % self._num_slots
+        for step in range(self._max_probe):
+            index = (home + step) % self._num_slots
+            offset = self._offset(index)
+            state, slot_hash, expiry, key_length, _ = _SLOT.unpack_from(table, offset)
+            if state in _LIVE and expiry <= now:
+                self._free(table, index)
+                state = table[offset]
+            if state == EMPTY:
+                return None, index if free is None else free
+            if state in _LIVE and slot_hash == key_hash:
+                start = offset + _SLOT.size
+                if table[start:start + key_length] == key_bytes:
+                    return index, None
+            if state == DELETED and free is None:
+                free = index
+        return None, free
+
+    def _free(self, table, index):
+        """
+        Deletes the entry in a slot. Probes stop at the first empty slot, so a
+        run of tombstones followed by an empty slot is emptied too.
+        """
+        table[self._offset(index)] = DELETED
+        if table[self._offset((index + 1) % self._num_slots)] != EMPTY:
+            return
+        while table[self._offset(index)] == DELETED:
+            table[self._offset(index)] = EMPTY
+            index = (index - 1) % self._num_slots
+
+    def _evict(self, table, key_hash):
+        """Returns the slot in the key's probe window closest to expiry that does not hold a lock"""
+        victim = None
+        victim_expiry = None
+        home = key_hash % self._num_slots
+        for step in range(self._max_probe):
+            index = (home + step) % self._num_slots
+            state, _, expiry, _, _ = _SLOT.unpack_from(table, self._offset(index))
+            if state == USED and (victim is None or expiry < victim_expiry):
+                victim = index
+                victim_expiry = expiry
+        return victim
+
+    def _read(self, table, index):
+        offset = self._offset(index)
+        _, _, expiry, key_length, value_length = _SLOT.unpack_from(table, offset)
+        start = offset + _SLOT.size + key_length
+        return table[start:start + value_length], expiry
+
+    def _store(self, table, key, value, expiry, only_if_missing=False, locked=False):
+        key_bytes = key.encode()
+        if _SLOT.size + len(key_bytes) + len(value) > self._slot_size:
+            raise ValueError("Entry for '%s' does not fit in a %d byte slot" % (key, self._slot_size))
+
+        key_hash = _hash(key_bytes)
+        index, free = self._find(table, key_bytes, key_hash)
+        if index is not None:
+            if only_if_missing:
+                return False
+        elif free is not None:
+            index = free
+        else:
+            index = self._evict(table, key_hash)
+            if index is None:
+                raise ValueError("No slot for '%s', every slot it may use holds a lock" % key)
+
+        offset = self._offset(index)
+        start = offset + _SLOT.size
+        table[start:start + len(key_bytes)] = key_bytes
+        table[start + len(key_bytes):start + len(key_bytes) + len(value)] = value
+        state = LOCKED if locked else USED
+        _SLOT.pack_into(table, offset, state, key_hash, expiry, len(key_bytes), len(value))
+        return True
+
+    def _lookup(self, table, key):
+        key_bytes = key.encode()
+        index, _ = self._find(table, key_bytes, _hash(key_bytes))
+        return index
+
+    def _add_raw(self, key, value, timeout, locked=False):
+        with self._locked() as table:
+            return self._store(table, key, value, self._expiry(timeout), only_if_missing=True, locked=locked)
+
+    def _delete_raw(self, key, expected=None):
+        with self._locked() as table:
+            index = self._lookup(table, key)
+            if index is None:
+                return False
+            if expected is not None and self._read(table, index)[0] != expected:
+                return False
+            self._free(table, index)
+            return True
+
+    def _touch_raw(self, key, timeout, expected=None):
+        with self._locked() as table:
+            index = self._lookup(table, key)
+            if index is None:
+                return False
+            if expected is not None and self._read(table, index)[0] != expected:
+                return False
+            _EXPIRY.pack_into(table, self._offset(index) + _EXPIRY_OFFSET, self._expiry(timeout))
+            return True
+
+    def add(self, key, value, timeout=DJANGO_DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        return self._add_raw(key, pickled, timeout)
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._locked() as table:
+            index = self._lookup(table, key)
+            if index is None:
+                return default
+            pickled, _ = self._read(table, index)
+        return pickle.loads(pickled)
+
+    def set(self, key, value, timeout=DJANGO_DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._locked() as table:
+            self._store(table, key, pickled, self._expiry(timeout))
+
+    def touch(self, key, timeout=DJANGO_DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return self._touch_raw(key, timeout)
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._locked() as table:
+            index = self._lookup(table, key)
+            if index is None:
+                raise ValueError("Key '%s' not found" % key)
+            pickled, expiry = self._read(table, index)
+            new_value = pickle.loads(pickled) + delta
+            self._store(table, key, pickle.dumps(new_value, pickle.HIGHEST_PROTOCOL), expiry)
+        return new_value
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return self._delete_raw(key)
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._locked() as table:
+            return self._lookup(table, key) is not None
+
+    def clear(self):
+        with self._locked() as table:
+            table[_HEADER.size:] = bytes(self._size - _HEADER.size)
+
+    def lock(self, key, version=None, timeout=DEFAULT_TIMEOUT, sleep=0.1, blocking_timeout=None, watchdog=False, **kwargs):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return SharedMemoryLock(self, key, timeout=timeout, sleep=sleep, blocking_timeout=blocking_timeout, watchdog=watchdog)
+
+    def ttl(self, key, version=None, **kwargs):
+        """Obtains the time before expiry for a given key"""
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._locked() as table:
+            return self._ttl(table, key)
+
+    def _ttl(self, table, key):
+        index = self._lookup(table, key)
+        if index is None:
+            return 0
+        expiry, = _EXPIRY.unpack_from(table, self._offset(index) + _EXPIRY_OFFSET)
+        if expiry == math.inf:
+            return None
+        return max(expiry - time.time(), 0)
+
+    def ttls(self, keys, version=None, **kwargs):
+        """Obtains the time before expiry for many keys while holding the lock once"""
+        return self._ttls(keys, version=version)
+
+    def _ttls(self, keys, version=None):
+        made_keys = []
+        for key in keys:
+            made_key = self.make_key(key, version=version)
+            self.validate_key(made_key)
+            made_keys.append((key, made_key))
+
+        with self._locked() as table:
+            return {key: self._ttl(table, made_key) for key, made_key in made_keys}
+
+    def counter(self, key, delta=1, timeout=DEFAULT_TIMEOUT, version=None, **kwargs):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+
+        with self._locked() as table:
+            index = self._lookup(table, key)
+            if index is None:
+                new_value = delta
+            else:
+                pickled, _ = self._read(table, index)
+                new_value = pickle.loads(pickled) + delta
+            pickled = pickle.dumps(new_value, pickle.HIGHEST_PROTOCOL)
+            self._store(table, key, pickled, self._expiry(timeout))
+        return new_value
+
+    def age(self, key, original_ttl, version=None, **kwargs):
+        ttl = self._ttls([key], version=version)[key]
+        if ttl is None:
+            return None
+        return original_ttl - ttl
+
+    def ages(self, keys, original_ttl, version=None, **kwargs):
+        ttls = self._ttls(keys, version=version)
+        return {key: None if ttl is None else original_ttl - ttl for key, ttl in ttls.items()}
+
+    def delete_and_set_hashmap(self, key, dictionary, **kwargs):
+        self._set_hashmap(key, dictionary, clear_existing=True, **kwargs)
+
+    def set_hashmap(self, key, dictionary, **kwargs):
+        self._set_hashmap(key, dictionary, clear_existing=False, **kwargs)
+
+    def _set_hashmap(self, key, hashmap, version=None, last_set_key="_last_set", clear_existing=False, **kwargs):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+
+        if type(hashmap) is not dict:
+            raise ValueError("set_hashmap expects dictionary to be a dict type")
+
+        def NotStringException():
+            raise TypeError("Hashmap keys must be strings")
+
+        hashmap = {key if type(key) is str else NotStringException(): pickle.dumps(value, pickle.HIGHEST_PROTOCOL) for key, value in hashmap.items()}
+
+        # store update time
+        # we pop this off before returning all keys
+        hashmap[last_set_key] = pickle.dumps(int(time.time()), pickle.HIGHEST_PROTOCOL)
+
+        with self._locked() as table:
+            index = self._lookup(table, key)
+            if index is None or clear_existing:
+                dictionary = hashmap
+            else:
+                dictionary = pickle.loads(self._read(table, index)[0])
+                dictionary.update(hashmap)
+            pickled = pickle.dumps(dictionary, pickle.HIGHEST_PROTOCOL)
+            self._store(table, key, pickled, math.inf)
+
+    def _get_hashmap(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._locked() as table:
+            index = self._lookup(table, key)
+            if index is None:
+                return {}
+            pickled, _ = self._read(table, index)
+        return pickle.loads(pickled)
+
+    def get_hashmap(self, key, version=None, last_set_key="_last_set", **kwargs):
+        """
+        Returns a python dictionary if it exists otherwise {}.
+        """
+        dictionary = self._get_hashmap(key, version=version)
+        dictionary.pop(last_set_key, None)
+        return {key: pickle.loads(value) for key, value in dictionary.items()}
+
+    def get_hashmap_value(self, key, field, version=None, **kwargs):
+        if type(field) is not str:
+            raise TypeError("Hashmap keys must be strings")
+
+        value = self._get_hashmap(key, version=version).get(field, None)
+        if value is not None:
+            value = pickle.loads(value)
+        return value
@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 SECRET_KEY = "django_tests_secret_key"
 
 CACHES = {
@@ -9,14 +12,55 @@ CACHES = {
         ],
         "KEY_PREFIX": "test-prefix",
     },
+    "unreachable_replica": {
+        "BACKEND": "extended_django_redis.redis_cache.ExtendedRedisCache",
+        "LOCATION": [
+            "redis://127.0.0.1:6379?db=1",
+            # nothing listens here
+            "redis://127.0.0.1:6390?db=1",
+        ],
+        "KEY_PREFIX": "test-unreachable",
+        "OPTIONS": {
+            "SOCKET_CONNECT_TIMEOUT": 1,
+        },
+    },
     "locmem": {
         'BACKEND': 'extended_django_redis.locmem_cache.ExtendedLocMemCache',
 
-    }
+    },
+    "shared_memory": {
+        "BACKEND": "extended_django_redis.shared_memory_cache.ExtendedSharedMemoryCache",
+        "LOCATION": os.path.join(tempfile.gettempdir(), "extended-django-redis-tests.cache"),
+        "OPTIONS": {
+            "MAX_ENTRIES": 1024,
+            "SLOT_SIZE": 512,
+        },
+    },
+    "shared_memory_small": {
+        "BACKEND": "extended_django_redis.shared_memory_cache.ExtendedSharedMemoryCache",
+        "LOCATION": os.path.join(tempfile.gettempdir(), "extended-django-redis-tests-small.cache"),
+        "OPTIONS": {
+            "MAX_ENTRIES": 64,
+            "SLOT_SIZE": 256,
+            "MAX_PROBE": 8,
+        },
+    },
+    "profiled": {
+        "BACKEND": "extended_django_redis.locmem_cache.ExtendedLocMemCache",
+        "LOCATION": "profiled",
+        "OPTIONS": {
+            "PROFILER": {
+                "SAMPLE_RATE": 1,
+                "CAPACITY": 4,
+                "REPORT_DIR": os.path.join(tempfile.gettempdir(), "extended-django-redis-tests-hot-keys"),
+            },
+        },
+    },
 }
 
 INSTALLED_APPS = (
     "django.contrib.sessions",
+    "extended_django_redis",
 )
 
 SETTINGS_DICT = {
@@ -1,8 +1,21 @@
 from unittest import TestCase
 from django.core.cache import cache, caches
-from redis.exceptions import LockError
+from django_redis.exceptions import ConnectionInterrupted
+from redis.exceptions import ConnectionError as RedisConnectionError, LockError
+from extended_django_redis.client.read_router import ReadRouter, replication_lag
+from extended_django_redis.locks import lock_statistics
+from extended_django_redis.profiler import SpaceSaving
+from django.core.management import call_command
+from io import StringIO
+import gc
+import json
 import time
 import threading
+import weakref
+import multiprocessing
+import os
+import shutil
+import tempfile
 from settings import SETTINGS_DICT
 from django.conf import settings
 
@@ -62,6 +75,29 @@ class DjangoRedisCacheTests(TestCase):
     self.cache.set(test_key, 1, timeout=None)
     self.assertEqual(self.cache.age(test_key, 2), None)
 
+  def test_ttls_and_ages(self):
+    self.cache.set("a", 1, timeout=10)
+    self.cache.set("b", 1, timeout=None)
+    ttls = self.cache.ttls(["a", "b", "missing"])
+    self.assertEqual(set(ttls), {"a", "b", "missing"})
+    self.assertAlmostEqual(ttls["a"], 10, 1)
+    self.assertIsNone(ttls["b"])
+    self.assertEqual(ttls["missing"], 0)
+
+    time.sleep(1)
+    ages = self.cache.ages(["a", "b", "missing"], 10)
+    self.assertAlmostEqual(ages["a"], 1, 1)
+    self.assertIsNone(ages["b"])
+    self.assertEqual(ages["missing"], 10)
+
+  def test_hashmap_last_set(self):
+    test_key = "test_key"
+    self.cache.set_hashmap(test_key, {"a": "cat"})
+    self.assertAlmostEqual(self.cache.get_hashmap_value(test_key, "_last_set"), time.time(), delta=2)
+    self.cache.delete_and_set_hashmap(test_key, {})
+    self.assertAlmostEqual(self.cache.get_hashmap_value(test_key, "_last_set"), time.time(), delta=2)
+    self.assertEqual(self.cache.get_hashmap(test_key), {})
+
   def test_set_hashmap(self):
     test_key = "test_key"
     hashmap = {"a": '☢', "b": 'dog', 'c': 3}
@@ -168,7 +204,7 @@ class DjangoRedisCacheTests(TestCase):
 
     thread = threading.Thread(target=acquire_and_release_lock)
     thread.start()
-    self.assertTrue(thread.isAlive())
+    self.assertTrue(thread.is_alive())
     lock.release()
 
     # set a blocking timeout, we should stop trying to acquire the lock after the blocking
@@ -192,6 +228,189 @@ class DjangoRedisCacheTests(TestCase):
     # but if we pass in ignore_lock_errors then we shouldn't get an error
     lock4.release(ignore_lock_errors=True)
 
+  def test_lock_watchdog(self):
+    lock_key = "foobar"
+    lock = self.cache.lock(lock_key, timeout=1, watchdog=True)
+    self.assertTrue(lock.acquire())
+
+    # the lease should be renewed for as long as we hold the lock
+    time.sleep(2)
+    self.assertFalse(self.cache.lock(lock_key).acquire(blocking=False))
+
+    # releasing should stop the renewals and free the lock
+    lock.release()
+    lock2 = self.cache.lock(lock_key, timeout=1)
+    self.assertTrue(lock2.acquire(blocking=False))
+    lock2.release()
+
+    # a watchdog needs a lease to renew
+    with self.assertRaises(self.lock_error):
+      self.cache.lock(lock_key, timeout=None, watchdog=True)
+
+  def test_lock_watchdog_stops_with_its_holder(self):
+    lock_key = "foobar"
+    locks = []
+
+    def hold_and_exit():
+      lock = self.cache.lock(lock_key, timeout=1, watchdog=True)
+      locks.append(lock)
+      lock.acquire()
+
+    thread = threading.Thread(target=hold_and_exit)
+    thread.start()
+    thread.join()
+
+    # the holder exited without releasing so the lock lapses after one lease
+    self.assertFalse(self.cache.lock(lock_key).acquire(blocking=False))
+    time.sleep(1.5)
+    lock = self.cache.lock(lock_key, timeout=1, watchdog=True)
+    self.assertTrue(lock.acquire(blocking=False))
+
+    # the watchdog does not keep a dropped lock alive
+    reference = weakref.ref(lock)
+    del lock
+    gc.collect()
+    self.assertIsNone(reference())
+
+  def test_lock_statistics(self):
+    lock_statistics.reset()
+    lock = self.cache.lock("foobar")
+    self.assertTrue(lock.acquire())
+    self.assertFalse(self.cache.lock("foobar").acquire(blocking=False))
+    time.sleep(0.1)
+    lock.release()
+
+    stats = lock_statistics.stats()[lock.name]
+    self.assertEqual(stats["acquired"], 1)
+    self.assertEqual(stats["failed"], 1)
+    self.assertEqual(stats["contended"], 1)
+    self.assertGreaterEqual(stats["hold_total"], 0.1)
+    self.assertEqual(lock_statistics.hot_locks(1)[0][0], lock.name)
+
+class ReadRouterTests(TestCase):
+
+  def test_routes_to_fastest_replica(self):
+    router = ReadRouter(3)
+    # unmeasured replicas are tried first
+    self.assertIn(router.choose(), (1, 2))
+    router.record(1, 0.010)
+    self.assertEqual(router.choose(), 2)
+    router.record(2, 0.001)
+    # the slower replica never gets a live read
+    self.assertEqual({router.choose() for _ in range(1000)}, {2})
+
+  def test_remeasures_replicas_with_probes(self):
+    delays = {1: 0.02, 2: 0}
+
+    def probe(index):
+      time.sleep(delays[index])
+      return 0
+
+    router = ReadRouter(3, latency_alpha=1, probe=probe)
+    router.check()
+    self.assertEqual(router.choose(), 2)
+
+    # once the slow replica recovers the probes alone move reads back to it
+    delays = {1: 0, 2: 0.02}
+    router.check()
+    self.assertEqual(router.choose(), 1)
+
+  def test_ejects_failed_replicas(self):
+    router = ReadRouter(3, eject_seconds=60)
+    router.record(1, 0.001)
+    router.record(2, 0.010)
+    router.eject(1)
+    self.assertEqual(router.choose(), 2)
+    # once every replica is out reads fall back to the primary
+    router.eject(2)
+    self.assertEqual(router.choose(), 0)
+    self.assertIn(router.choose(tried=[0]), (1, 2))
+
+  def test_read_your_writes(self):
+    router = ReadRouter(2, read_your_writes=0.5)
+    router.record_write()
+    self.assertEqual(router.choose(), 0)
+
+    # the pin only applies to the thread that wrote
+    choices = []
+    thread = threading.Thread(target=lambda: choices.append(router.choose()))
+    thread.start()
+    thread.join()
+    self.assertEqual(choices, [1])
+
+    time.sleep(0.5)
+    self.assertEqual(router.choose(), 1)
+
+    # without the option writes do not pin reads
+    router = ReadRouter(2)
+    router.record_write()
+    self.assertEqual(router.choose(), 1)
+
+  def test_ejects_lagging_replicas(self):
+    lags = {1: float("inf"), 2: 0.5, 3: 10}
+
+    def probe(index):
+      if index == 4:
+        raise RedisConnectionError()
+      return lags[index]
+
+    router = ReadRouter(5, eject_seconds=60, probe=probe, max_lag=5)
+    router.check()
+    # replica 1 lost its primary, 3 is too far behind and 4 cannot be reached
+    self.assertEqual({router.choose() for _ in range(20)}, {2})
+
+    # without MAX_REPLICA_LAG only a broken link counts
+    router = ReadRouter(4, eject_seconds=60, probe=probe)
+    router.check()
+    self.assertGreater(router._ejected_until[1], time.monotonic())
+    self.assertLessEqual(router._ejected_until[3], time.monotonic())
+
+  def test_replication_lag(self):
+    class Client:
+      def __init__(self, info):
+        self._info = info
+
+      def info(self, section):
+        return self._info
+
+    self.assertEqual(replication_lag(Client({"role": "master"})), 0)
+    self.assertEqual(replication_lag(Client({"role": "slave", "master_link_status": "down"})), float("inf"))
+    self.assertEqual(replication_lag(Client(
+      {"role": "slave", "master_link_status": "up", "master_last_io_seconds_ago": 3})), 3)
+
+  def test_checks_replicas_in_the_background(self):
+    router = cache.client._read_router
+    cache.get("key")
+    self.assertEqual(router._checking_pid, os.getpid())
+    # the test server is a primary, so its "replica" is never lagging
+    router.check()
+    self.assertLessEqual(router._ejected_until[1], time.monotonic())
+
+  def test_retries_reads_on_primary_when_replica_is_unreachable(self):
+    cache = caches["unreachable_replica"]
+    router = cache.client._read_router
+    cache.set("key", "value")
+    cache.set("other", "other value")
+
+    self.assertEqual(cache.get("key"), "value")
+    self.assertGreater(router._ejected_until[1], time.monotonic())
+    self.assertIsNone(router.latencies()[1])
+    self.assertIsNotNone(router.latencies()[0])
+
+    # while ejected every django redis read goes to the primary
+    self.assertEqual(cache.get_many(["key", "other"]), {"key": "value", "other": "other value"})
+    self.assertTrue(cache.has_key("key"))
+    self.assertGreater(cache.ttl("key"), 0)
+    cache.delete_many(["key", "other"])
+
+    # once every server has failed the error is raised
+    def unreachable(client):
+      raise RedisConnectionError()
+
+    with self.assertRaises(ConnectionInterrupted):
+      cache.client._read(unreachable)
+    self.assertGreater(router._ejected_until[0], time.monotonic())
+
 class DjangoLocMemCacheTests(DjangoRedisCacheTests):
 
     def setUp(self):
@@ -228,3 +447,324 @@ class DjangoLocMemCacheTests(DjangoRedisCacheTests):
         # Test ttl with not existent key
         ttl = self.cache.ttl("not-existent-key")
         self.assertEqual(ttl, 0)
+
+
+class DjangoLocMemSnapshotTests(TestCase):
+
+    def setUp(self):
+        if not settings.configured:
+            settings.configure(**SETTINGS_DICT)
+
+        self.cache = caches['locmem']
+        self.cache.clear()
+        self.path = os.path.join(tempfile.mkdtemp(), "snapshot")
+
+    def test_dump_and_load(self):
+        self.cache.set("a", "cat", timeout=None)
+        self.cache.set("b", {"dog": 1}, timeout=100)
+        self.cache.set("expired", "gone", timeout=1)
+        self.cache.set_hashmap("hashmap", {"a": "☢", "b": 3})
+        self.cache.get("a")
+        lock = self.cache.lock("foobar")
+        lock.acquire()
+        time.sleep(1)
+
+        # expired entries and locks should not be written
+        self.assertEqual(self.cache.dump(self.path), 3)
+        order = list(self.cache._cache)
+        self.cache.clear()
+
+        self.assertEqual(self.cache.load(self.path), 3)
+
+        # least recently used order should survive the reload
+        self.assertEqual(list(self.cache._cache), [key for key in order if key in self.cache._cache])
+
+        self.assertEqual(self.cache.get_hashmap("hashmap"), {"a": "☢", "b": 3})
+        self.assertEqual(self.cache.ttl("a"), None)
+        self.assertAlmostEqual(self.cache.ttl("b"), 99, 0)
+        self.assertIsNone(self.cache.get("expired"))
+        self.assertFalse(self.cache.has_key("foobar"))
+        self.assertEqual(self.cache.get("b"), {"dog": 1})
+
+    def test_load_keeps_existing_values(self):
+        self.cache.set("a", "old")
+        self.cache.dump(self.path)
+        self.cache.set("a", "new")
+        self.assertEqual(self.cache.load(self.path), 0)
+        self.assertEqual(self.cache.get("a"), "new")
+
+    def test_dump_releases_the_lock_between_batches(self):
+        from extended_django_redis import locmem_cache
+
+        for i in range(5):
+            self.cache.set("key-%d" % i, i)
+
+        cache_lock = self.cache._lock
+        holds = []
+
+        class CountingLock:
+            def __enter__(self):
+                cache_lock.acquire()
+                holds.append(1)
+
+            def __exit__(self, *args):
+                cache_lock.release()
+
+        batch_size = locmem_cache.DUMP_BATCH_SIZE
+        locmem_cache.DUMP_BATCH_SIZE = 2
+        self.cache._lock = CountingLock()
+        try:
+            self.assertEqual(self.cache.dump(self.path), 5)
+        finally:
+            self.cache._lock = cache_lock
+            locmem_cache.DUMP_BATCH_SIZE = batch_size
+
+        # once for the key order and once per batch of two
+        self.assertEqual(len(holds), 4)
+        self.cache.clear()
+        self.assertEqual(self.cache.load(self.path), 5)
+        self.assertEqual(self.cache.get("key-4"), 4)
+
+    def test_snapshots_continue_in_forked_children(self):
+        from extended_django_redis.locmem_cache import ExtendedLocMemCache
+
+        name = "fork-snapshots"
+        snapshot_cache = ExtendedLocMemCache(name, {"OPTIONS": {"SNAPSHOT_PATH": self.path, "SNAPSHOT_INTERVAL": 0.1}})
+        context = multiprocessing.get_context("fork")
+        result = context.Queue()
+
+        def snapshot_in_child():
+            dumped = []
+            snapshot_cache.dump = dumped.append
+            time.sleep(0.5)
+            threads = [thread.name for thread in threading.enumerate()]
+            result.put(("locmem-snapshot-%s" % name in threads, len(dumped) > 0))
+
+        worker = context.Process(target=snapshot_in_child)
+        worker.start()
+        worker.join()
+        self.assertEqual(result.get(), (True, True))
+
+    def test_failed_snapshot_is_logged(self):
+        self.cache.set("a", "cat")
+        missing_path = os.path.join(self.path, "missing", "snapshot")
+        with self.assertLogs("extended_django_redis.locmem_cache", level="ERROR"):
+            self.cache._dump_quietly(missing_path)
+        self.assertFalse(os.path.exists(missing_path))
+
+    def test_load_rejects_other_files(self):
+        with open(self.path, "wb") as f:
+            f.write(b"not a snapshot")
+        with self.assertRaises(ValueError):
+            self.cache.load(self.path)
+
+
+def increment_shared_counter(key, times):
+    shared_cache = caches['shared_memory']
+    for _ in range(times):
+        shared_cache.counter(key)
+
+
+class DjangoSharedMemoryCacheTests(DjangoLocMemCacheTests):
+
+    def setUp(self):
+        if not settings.configured:
+            settings.configure(**SETTINGS_DICT)
+
+        from extended_django_redis.locmem_cache import LockError as LocMemLockError
+
+        self.cache = caches['shared_memory']
+        self.default_timeout = 300
+        self.lock_error = LocMemLockError
+
+        try:
+          self.cache.clear()
+        except Exception:
+          pass
+
+    def test_counter_across_processes(self):
+        # every worker process should increment the same counter
+        context = multiprocessing.get_context("fork")
+        workers = [context.Process(target=increment_shared_counter, args=("test_key", 100)) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(self.cache.get("test_key"), 400)
+
+    def test_lock_across_processes(self):
+        lock = self.cache.lock("foobar")
+        self.assertTrue(lock.acquire())
+
+        # another process should not be able to acquire the lock while we hold it
+        context = multiprocessing.get_context("fork")
+        result = context.Queue()
+
+        def try_acquire():
+            result.put(caches['shared_memory'].lock("foobar").acquire(blocking=False))
+
+        worker = context.Process(target=try_acquire)
+        worker.start()
+        worker.join()
+        self.assertFalse(result.get())
+        lock.release()
+
+    def test_entry_too_large(self):
+        with self.assertRaises(ValueError):
+            self.cache.set("test_key", "x" * 1024)
+
+    def _slot_states(self, cache):
+        from extended_django_redis.shared_memory_cache import _HEADER
+        with cache._locked() as table:
+            return [table[_HEADER.size + i * cache._slot_size] for i in range(cache._num_slots)]
+
+    def test_deleted_slots_are_reclaimed(self):
+        from extended_django_redis.shared_memory_cache import EMPTY
+        # deleting every key should leave empty slots rather than tombstones that lengthen probes
+        for i in range(self.cache._num_slots):
+            self.cache.set("key-%d" % i, i)
+        for i in range(self.cache._num_slots):
+            self.cache.delete("key-%d" % i)
+        self.assertEqual(set(self._slot_states(self.cache)), {EMPTY})
+
+    def test_full_table(self):
+        small_cache = caches['shared_memory_small']
+        small_cache.clear()
+
+        # a full table evicts entries within the probe window instead of failing
+        for i in range(500):
+            small_cache.set("key-%d" % i, i)
+        self.assertEqual(small_cache.get("key-499"), 499)
+
+    def test_full_table_keeps_locks(self):
+        small_cache = caches['shared_memory_small']
+        small_cache.clear()
+        lock = small_cache.lock("foobar")
+        self.assertTrue(lock.acquire())
+
+        for i in range(500):
+            small_cache.set("key-%d" % i, i)
+
+        self.assertFalse(small_cache.lock("foobar").acquire(blocking=False))
+        lock.release()
+
+    def test_requires_a_private_location(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from extended_django_redis.shared_memory_cache import ExtendedSharedMemoryCache
+
+        with self.assertRaises(ImproperlyConfigured):
+            ExtendedSharedMemoryCache("", {})
+
+        # a file others can write could be used to plant pickles
+        path = os.path.join(tempfile.mkdtemp(), "shared.cache")
+        with open(path, "wb"):
+            pass
+        os.chmod(path, 0o666)
+        with self.assertRaises(ImproperlyConfigured):
+            ExtendedSharedMemoryCache(path, {}).get("test_key")
+
+        os.chmod(path, 0o600)
+        self.assertIsNone(ExtendedSharedMemoryCache(path, {}).get("test_key"))
+
+    def test_rejects_a_table_with_other_settings(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from extended_django_redis.shared_memory_cache import ExtendedSharedMemoryCache
+
+        path = os.path.join(tempfile.mkdtemp(), "shared.cache")
+        options = {"MAX_ENTRIES": 64, "SLOT_SIZE": 256, "MAX_PROBE": 8}
+        ExtendedSharedMemoryCache(path, {"OPTIONS": options}).set("test_key", 1)
+        for option, value in (("MAX_ENTRIES", 128), ("SLOT_SIZE", 512), ("MAX_PROBE", 4)):
+            with self.assertRaises(ImproperlyConfigured):
+                ExtendedSharedMemoryCache(path, {"OPTIONS": dict(options, **{option: value})}).get("test_key")
+
+    def test_reattach_closes_inherited_table(self):
+        self.cache.get("test_key")
+        inherited_map = self.cache._map
+
+        # as if this were a forked child
+        self.cache._pid = None
+        self.cache.get("test_key")
+        self.assertTrue(inherited_map.closed)
+        self.assertIsNot(self.cache._map, inherited_map)
+
+
+class KeyProfilerTests(TestCase):
+
+    def setUp(self):
+        if not settings.configured:
+            settings.configure(**SETTINGS_DICT)
+
+        self.cache = caches['profiled']
+        self.cache.clear()
+        self.cache._profiler.reset()
+
+    def test_space_saving(self):
+        counter = SpaceSaving(2)
+        for item in ["a", "a", "a", "b", "c"]:
+            counter.offer(item)
+        # c replaces b and inherits its count as the error
+        self.assertEqual(counter.top(2), [("a", 3, 0), ("c", 2, 1)])
+
+    def test_hot_keys(self):
+        for _ in range(3):
+            self.cache.get("a")
+        self.cache.set("user:1", "x" * 100)
+        self.cache.set_hashmap("user:2", {"name": "cat"})
+        self.cache.counter("requests")
+        # get_many is built on get so each key should only be counted once
+        self.cache.get_many(["a", "b"])
+
+        report = self.cache.hot_keys(2)
+        self.assertEqual(report["keys"][0], {"key": "a", "count": 4, "error": 0})
+        self.assertEqual(report["prefixes"][0]["prefix"], "user")
+        self.assertGreater(report["prefixes"][0]["bytes"], 100)
+        self.assertEqual(report["operations"], {"get": 5, "set": 1, "set_hashmap": 1, "counter": 1})
+        # misses move no bytes so they do not take a prefix slot
+        self.assertNotIn("a", [entry["prefix"] for entry in self.cache.hot_keys()["prefixes"]])
+
+        # caches without a profiler have nothing to report
+        with self.assertRaises(ValueError):
+            caches['locmem'].hot_keys()
+
+    def test_hot_keys_command(self):
+        shutil.rmtree(self.cache._profiler.report_dir, ignore_errors=True)
+        self.cache.get("a")
+        self.cache._profiler.write_report()
+
+        out = StringIO()
+        call_command("hot_keys", cache="profiled", stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report["keys"], [{"key": "a", "count": 1}])
+        self.assertEqual(report["operations"], {"get": 1})
+
+    def test_hot_keys_command_requires_report_dir(self):
+        from django.core.management.base import CommandError
+
+        profiler = self.cache._profiler
+        report_dir = profiler.report_dir
+        profiler.report_dir = None
+        try:
+            with self.assertRaises(CommandError):
+                call_command("hot_keys", cache="profiled", stdout=StringIO())
+        finally:
+            profiler.report_dir = report_dir
+
+    def test_hot_keys_command_drops_stale_reports(self):
+        profiler = self.cache._profiler
+        shutil.rmtree(profiler.report_dir, ignore_errors=True)
+        self.cache.get("a")
+        profiler.write_report()
+
+        # a report left behind by a process that exited long ago
+        stale_path = os.path.join(profiler.report_dir, "hot-keys-999999999.json")
+        with open(stale_path, "w") as f:
+            json.dump({"keys": [{"key": "gone", "count": 100}], "prefixes": [], "operations": {"get": 100}}, f)
+        stale_time = time.time() - profiler.report_interval * 4
+        os.utime(stale_path, (stale_time, stale_time))
+
+        out = StringIO()
+        call_command("hot_keys", cache="profiled", stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report["keys"], [{"key": "a", "count": 1}])
+        self.assertEqual(report["operations"], {"get": 1})
+        self.assertFalse(os.path.exists(stale_path))